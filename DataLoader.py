@@ -1,21 +1,69 @@
 import glob
 import os
 import random
+from multiprocessing import Pool
 from pathlib import Path
 
 import numpy as np
-import sklearn
-from scipy.io import wavfile
 
-from helpers import write_log
+from helpers import write_log, read_wavs, quantize_mulaw
+
+# The original wav files, shared with the worker processes that generate the test set
+_source_data: list = None
+
+
+def _init_worker(data: list):
+    """
+    Initialize a worker process of DataLoader.__generate_test_set. Set the data once per process, instead of
+    pickling it for each task
+    :param data: The original wav files
+    """
+    global _source_data
+    _source_data = data
+
+
+def _create_concurrent_speakers(records_file: str, num_speakers: int, offset: int, num_records: int, order: list):
+    """
+    Generate records with concurrent speakers. Runs in a worker process, see _init_worker
+    - Each record is the sum of num_speakers original files, padded to and cut off at pad_to frames, and normalized to [-1, 1]
+    - The records are written to rows offset up to offset + num_records of the array in records_file. Records are
+        quantized to 8 bit mu-law if that array is of type uint8, see helpers.quantize_mulaw
+    :param records_file: The .npy file that contains the array of records of all speaker counts
+    :param num_speakers:  The number of speakers per sample
+    :param offset: The first row to write to
+    :param num_records:  The number of samples to create
+    :param order: The shuffled indices of the original wav files
+    """
+    write_log(f'Generating test files for {num_speakers} concurrent speakers')
+    data = [_source_data[i] for i in order]
+    # Generate partitions of length num_speakers
+    partitions = [data[i:i + num_speakers] for i in range(0, num_records * num_speakers, num_speakers)]
+
+    records = np.load(records_file, mmap_mode='r+')
+    quantize = records.dtype == np.uint8
+    pad_to = records.shape[1]
+    mix = np.empty(pad_to, dtype=np.float32)
+    for i, partition in enumerate(partitions):
+        # Sum the speakers into one zero-filled array
+        mix[:] = 0
+        for x in partition:
+            n = min(len(x), pad_to)
+            mix[:n] += x[:n]
+        peak = np.max(np.abs(mix))
+        if peak > 0:
+            mix /= peak
+        records[offset + i] = quantize_mulaw(mix) if quantize else mix
+    records.flush()
 
 
 class DataLoader:
     """
-    Class responsible for loading filenames from filesystem
-    - Can generate the CUSTOM_TIMIT dataset by merging wav files from TIMIT. This is used to generate TEST sets.
-    - Can load datasets from files. Datasets are simply lists of filenames and a corresponding list of speaker counts.
-        these lists are used to generated merged WAV files in the TrainsetGenerator
+    Class responsible for loading datasets from filesystem
+    - Can generate the CUSTOM_TIMIT dataset by merging wav files from TIMIT. This is used to generate TEST sets. The
+        merged records of all speaker counts are saved in one contiguous array in test_x.npy, the labels in test_y.npy.
+        Quantized sets are saved in test_x_mulaw.npy and test_y_mulaw.npy instead
+    - Can load datasets from files. The train set is simply a list of filenames, which is used to generate merged
+        WAV files in the TrainsetGenerator. The test set is an array of merged records and a corresponding list of speaker counts
     """
     # Location of data
     train_dir: str
@@ -31,6 +79,13 @@ class DataLoader:
     # Files are sampled at 16kHz
     sampled_at = 16000
 
+    # Pad to and cut off the generated records at 5 seconds, like the TrainSetGenerator does
+    pad_to = sampled_at * 5
+
+    # If true, store the generated test records as 8 bit mu-law instead of float16. Halves the size of the test set,
+    # at the cost of precision. The TestSetGenerator reads both
+    quantize = False
+
     # If true, always regenerate data, even if dirs already exist
     force_recreate = False
 
@@ -42,7 +97,7 @@ class DataLoader:
         Save the src and dest dir
         :param train_dir: Dir that contains the original Timit train files
         :param test_src_dr: Dir that contains the original Timit test files
-        :param test_dest_dir:  Dir that will contain the generated merged test wav files
+        :param test_dest_dir:  Dir that will contain the generated merged test records
         """
         self.train_dir = train_dir
         self.test_src_dir = test_src_dr
@@ -51,10 +106,10 @@ class DataLoader:
     def load_data(self):
         """
         Load data from train_dest_dir and test_dest_dir.
-        - If test dest dir does not exist, generated test set
+        - If the test set does not exist, generate it
         :return train, test_x, test_y
         """
-        if self.force_recreate or not os.path.exists(self.test_dest_dir):
+        if self.force_recreate or not self.__test_set_exists():
             self.__generate_test_set()
         return self.__load_datasets()
 
@@ -80,19 +135,31 @@ class DataLoader:
     def __load_datasets(self):
         """
         Load datasets:
-        - Loop over all train and test files
-        - Create lists of filenames and speaker counts
+        - Create list of train filenames
+        - Load the test records and labels. The records are memory-mapped, such that only the rows a batch needs are read
         :return train (filenames), (test_x, test_y)
         """
         train = glob.glob(self.train_dir + '/*.WAV')
-        test_x, test_y = [], []
-        for y in range(self.min_speakers, self.max_speakers + 1):
-            dir = f'{self.test_dest_dir}/{y}'
+        x_file, y_file = self.get_test_set_files()
+        test_x = np.load(x_file, mmap_mode='r')
+        test_y = np.load(y_file)
+        return np.array(train), (test_x, test_y)
 
-            files = glob.glob(dir + '/*.wav')
-            test_x.extend(files)
-            test_y.extend([y] * len(files))
-        return np.array(train), (np.array(test_x), np.array(test_y))
+    def get_test_set_files(self):
+        """
+        Get the filenames of the generated test set. The storage format is part of the name, such that toggling
+        quantize does not load a set that was stored in the other format
+        :return: The file of the records, the file of the labels
+        """
+        suffix = '_mulaw' if self.quantize else ''
+        return f'{self.test_dest_dir}/test_x{suffix}.npy', f'{self.test_dest_dir}/test_y{suffix}.npy'
+
+    def __test_set_exists(self):
+        """
+        Check whether the test set is generated. The labels are saved last, hence an incomplete set has no labels
+        :return: bool
+        """
+        return all(os.path.exists(file) for file in self.get_test_set_files())
 
     def __generate_test_set(self):
         """
@@ -100,38 +167,35 @@ class DataLoader:
         """
 
         # If yet generated, skip
-        if os.path.exists(self.test_dest_dir):
+        if not self.force_recreate and self.__test_set_exists():
             return
 
         write_log('Generating Test set')
         files = glob.glob(self.test_src_dir + '/*.WAV')
         num_records_per_count = len(files) // self.max_speakers
-        data = [record for (_, record) in [wavfile.read(wav) for wav in files]]
-        for i in range(self.min_speakers, self.max_speakers + 1):
-            write_log(f'Generating test files for {i} concurrent speakers')
-            self.__create_concurrent_speakers(data, self.test_dest_dir, i, num_records_per_count)
+        # Only the first pad_to frames of each file are used in the records, hence do not read the remaining frames
+        data = read_wavs(files, self.pad_to)
+
+        # Create the array of records of all speaker counts, the workers fill the rows of their speaker count
+        Path(self.test_dest_dir).mkdir(parents=True, exist_ok=True)
+        x_file, y_file = self.get_test_set_files()
+        # Remove the labels of an existing set first, such that an interrupted run does not leave a set that looks complete
+        if os.path.exists(y_file):
+            os.remove(y_file)
+        counts = range(self.min_speakers, self.max_speakers + 1)
+        dtype = np.uint8 if self.quantize else np.float16
+        np.lib.format.open_memmap(x_file, mode='w+', dtype=dtype, shape=(len(counts) * num_records_per_count, self.pad_to))
+
+        # The set is shuffled again for each speaker count. Shuffle the indices up front, such that each speaker
+        # count can be generated independently
+        order = list(range(len(data)))
+        tasks = []
+        for offset, i in enumerate(counts):
+            random.Random(self.random_state).shuffle(order)
+            tasks.append((x_file, i, offset * num_records_per_count, num_records_per_count, list(order)))
+
+        # Generate the records for each speaker count in parallel
+        with Pool(min(os.cpu_count(), len(tasks)), initializer=_init_worker, initargs=(data,)) as pool:
+            pool.starmap(_create_concurrent_speakers, tasks)
+        np.save(y_file, np.repeat(counts, num_records_per_count))
         write_log('Data generated')
-
-    def __create_concurrent_speakers(self, data, dest_dir, num_speakers, num_records):
-        """
-        Generate wav files with concurrent speakers
-        :param dest_dir:  The dir to save the new files in
-        :param data:  The original wav files
-        :param num_speakers:  The number of speakers per sample
-        :param num_records:  The number of samples to create
-        """
-        # Save files in subdir with name 'num_speakers'
-        dest_dir += f'/{num_speakers}'
-        Path(dest_dir).mkdir(parents=True, exist_ok=True)
-        # Shuffle the set
-        random.Random(self.random_state).shuffle(data)
-        # Generate partitions of length num_speakers
-        partitions = [data[i:i + num_speakers] for i in range(0, num_records * num_speakers, num_speakers)]
-
-        for i, partition in enumerate(partitions):
-            # Pad to size of longest file
-            pad_to = len(max(partition, key=len))
-            partition = np.array([np.pad(x, (0, pad_to - len(x))) for x in partition])
-            dest_filename = f'{dest_dir}/{i}.wav'
-            with open(dest_filename, 'wb+') as dest_file:
-                wavfile.write(dest_file, self.sampled_at, partition.T)
@@ -2,14 +2,12 @@ import glob
 import json
 import csv
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 from DataLoader import DataLoader
 from RNN import RNN
 from TrainSetGenerator import TrainSetGenerator
 from scipy import stats
-from matplotlib import rc
 
 
 def flatten(S):
@@ -36,6 +34,7 @@ class Experimenter:
     libri_dir = './data/LibriCount/test'
 
     dest_dir = './data/experiments'
+    features_dir = f'{dest_dir}/features'
 
     feature_options = TrainSetGenerator.FEATURE_OPTIONS
 
@@ -72,8 +71,8 @@ class Experimenter:
 
                 # Test performance
                 for test_name, test_data_current in test_data.items():
-                    x, y = test_data_current['x'], test_data_current['y']
-                    experiment_for_feature[test_name] = self.__test_net(network, x, y, feature_type)
+                    x, y, source = test_data_current['x'], test_data_current['y'], test_data_current['source']
+                    experiment_for_feature[test_name] = self.__test_net(network, test_name, x, y, source, feature_type)
 
                 experiment_for_trainset[feature_type] = experiment_for_feature
             experiments[f'train_{min_speakers}_{max_speakers}'] = experiment_for_trainset
@@ -95,16 +94,19 @@ class Experimenter:
         _, history = network.train(files, min_speakers, max_speakers, feature_type)
         return network, history
 
-    def __test_net(self, network: RNN, x: np.ndarray, y: np.ndarray, feature_type: str):
+    def __test_net(self, network: RNN, test_name: str, x: np.ndarray, y: np.ndarray, source: str, feature_type: str):
         """
-        Test a trained network
+        Test a trained network. The features of each test set are cached, since each set is tested on multiple networks
         :param network:  The trained network
-        :param x: The test files (pre-merged)
+        :param test_name: The name of the test set
+        :param x: The test files or records (pre-merged)
         :param y:  The corresponding labels
+        :param source: The file or dir the test set is loaded from. Cached features are recomputed if it changed
         :param feature_type:  The feature type, must be the same as used for traning
         :return: MAE on different levels
         """
-        return network.test(x, y, feature_type)
+        features_file = f'{self.features_dir}/{test_name}/{feature_type}.npy'
+        return network.test(x, y, feature_type, features_file=features_file, source=source)
 
     def __get_train_data(self):
         """
@@ -130,12 +132,13 @@ class Experimenter:
 
     def __get_test_data(self):
         """
-        The test data are actually X, Y, where X is a list of filenames with pre-merged wavs.
+        The test data are actually X, Y, where X is a list of filenames with pre-merged wavs (libri), or an array of pre-merged records (timit).
         We pre-merge them, such that we have the same test set each time. Are created and saved to FS using the DataLoader
         :return: {
             'test_set_type' : {
-                'x': pre-merged wav files
+                'x': pre-merged wav files or records
                 'y': labels
+                'source': file or dir the set is loaded from
             }
         }
         """
@@ -144,16 +147,18 @@ class Experimenter:
         data = {
             'libri': {
                 'x': libri_x,
-                'y': libri_y
+                'y': libri_y,
+                'source': self.libri_dir,
             }
         }
         # Load two versions of timit
         for (min_speakes, max_speakers) in [(1, 10), (1, 20)]:
             # If not yet exist, generate data. Then save test x and y in np arrays
-            test_x, test_y = self.__load_timit_test(min_speakes, max_speakers)
+            test_x, test_y, source = self.__load_timit_test(min_speakes, max_speakers)
             data[f'{min_speakes}_to_{max_speakers}'] = {
                 'x': test_x,
-                'y': test_y
+                'y': test_y,
+                'source': source,
             }
         return data
 
@@ -162,6 +167,9 @@ class Experimenter:
         Visualize results as needed for Section 5.3 of the paper
         :param file: experiments.json
         """
+        import matplotlib.pyplot as plt
+        from matplotlib import rc
+
         # Load results
         with open(file) as json_file:
             content = json.load(json_file)
@@ -197,6 +205,9 @@ class Experimenter:
         Visualize results as needed for Section 5.2 of the paper
         :param file: experiments.json
         """
+        import matplotlib.pyplot as plt
+        from matplotlib import rc
+
         # Load results
         with open(file) as json_file:
             content = json.load(json_file)
@@ -281,8 +292,8 @@ class Experimenter:
 
                 # Test performance
                 for test_name, test_data_current in data.items():
-                    x, y = test_data_current['x'], test_data_current['y']
-                    result_for_feature[test_name] = self.__test_net(network, x, y, feature_type)
+                    x, y, source = test_data_current['x'], test_data_current['y'], test_data_current['source']
+                    result_for_feature[test_name] = self.__test_net(network, test_name, x, y, source, feature_type)
 
                 result_for_trainset[feature_type] = result_for_feature
             result[f'train_{min_speakers}_{max_speakers}'] = result_for_trainset
@@ -295,14 +306,16 @@ class Experimenter:
         Load timit test set
         :param min_count: The minimum max number of speakers per file
         :param max_count:  The maximum max number of speakers per file
-        :return:  test_x, test_y
+        :return:  test_x, test_y, the file the test set is loaded from
         """
         test_dest_dir = f"{self.dest_dir}/{min_count}_to_{max_count}/test"
         data_loader = DataLoader(self.train_dir, self.test_dir, test_dest_dir)
         data_loader.min_speakers = min_count
         data_loader.max_speakers = max_count
         _, (test_x, test_y) = data_loader.load_data()
-        return test_x, test_y
+        # The labels are saved last when the set is generated
+        _, y_file = data_loader.get_test_set_files()
+        return test_x, test_y, y_file
 
     def __load_libri(self):
         """
@@ -4,7 +4,6 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.keras.backend as K
 import tensorflow_probability as tfp
-from sklearn.metrics import mean_absolute_error
 from tensorflow.python.keras.callbacks import EarlyStopping, ReduceLROnPlateau, ModelCheckpoint
 from tensorflow.python.keras.optimizer_v2.adam import Adam
 
@@ -14,10 +13,10 @@ from TrainSetGenerator import TrainSetGenerator
 from helpers import write_log
 
 tfd = tfp.distributions
+from tensorflow.keras import mixed_precision
 from tensorflow.keras.layers import Dense, InputLayer, Bidirectional, LSTM, Masking
 from tensorflow.keras.models import Sequential
 from scipy.stats import poisson
-import matplotlib.pyplot as plt
 
 
 class RNN:
@@ -42,6 +41,9 @@ class RNN:
     # To reproduce
     random_state = 1337
 
+    # If true and a GPU is available, compute in float16 where possible. The output layer stays in float32
+    use_mixed_precision = True
+
     # Set num_files_to_merge on the train/validation generators to this value * len(set). We will re-use each file this number of times
     use_train_files_times = 5
     use_validation_files_times = 2
@@ -69,6 +71,8 @@ class RNN:
         :param input_shape the input shape:  [batch_size, time_steps, n_features]
         :return: The net
         """
+        if self.use_mixed_precision and tf.config.list_physical_devices('GPU'):
+            mixed_precision.set_global_policy('mixed_float16')
         net = Sequential()
         net.add(InputLayer(input_shape=input_shape))
         # Mask the input
@@ -79,8 +83,9 @@ class RNN:
         net.add(Bidirectional(LSTM(40, activation='tanh', return_sequences=False, dropout=0.5)))
 
         net.add(Dense(20, activation='relu'))
-        # The network predicts scale parameter \lambda for the poisson distribution
-        net.add(Dense(1, activation='exponential'))
+        # The network predicts scale parameter \lambda for the poisson distribution. Compute it in float32, such that
+        # the exponential and the poisson loss are numerically stable under mixed precision
+        net.add(Dense(1, activation='exponential', dtype='float32'))
 
         return net
 
@@ -131,8 +136,9 @@ class RNN:
         :param feature_type: The feature type
         :return: train_generator, (val_x, val_y)
         """
-        # Split files into trai nval
-        np.random.shuffle(files)
+        # Split files into train val. Shuffle a permutation of indices with a fixed seed, such that the split is
+        # reproducible, and the files of the caller are not shuffled in place
+        files = np.asarray(files)[np.random.default_rng(self.random_state).permutation(len(files))]
         split_index = int(len(files) * .8)
         train_files = files[:split_index]
         validation_files = files[split_index:]
@@ -148,12 +154,32 @@ class RNN:
         # No augmentation on the validation set
         validation_generator.augment = False
         validation_generator.set_num_files_to_merge(self.use_validation_files_times * len(validation_files))
-        # Generate a full set
-        validation_set = list(validation_generator.__iter__())[0]
-        val_x, val_y = validation_set[0], validation_set[1]
+        # Generate a set from the first batch. Only generate that batch, instead of iterating over all batches
+        val_x, val_y = validation_generator[0]
 
         return train_generator, (val_x, val_y)
 
+    @staticmethod
+    def __to_dataset(generator: TrainSetGenerator):
+        """
+        Wrap a generator in a tf.data.Dataset, which prefetches batches while the network trains on the current batch
+        - Batches are not cached, since the generator merges and augments files at random each epoch
+        - on_epoch_end of the generator is called after the last batch, as keras does for a Sequence
+        :param generator: The generator
+        :return: The dataset
+        """
+
+        def generate():
+            for batch_index in range(len(generator)):
+                yield generator[batch_index]
+            generator.on_epoch_end()
+
+        output_signature = (
+            tf.TensorSpec(shape=(None,) + generator.feature_shape, dtype=tf.float32),
+            tf.TensorSpec(shape=(None,), dtype=tf.float32),
+        )
+        return tf.data.Dataset.from_generator(generate, output_signature=output_signature).prefetch(tf.data.AUTOTUNE)
+
     def train(self, files: np.ndarray, min_speakers: int, max_speakers: int, feature_type: str):
         """
         Train the network, eg
@@ -167,9 +193,11 @@ class RNN:
         """
         train_generator, (val_x, val_y) = self.__get_train_data(files, min_speakers, max_speakers, feature_type)
         net = self.compile_net(train_generator.feature_shape)
+        # Convert the validation set to tensors once, such that it is not copied to the device on each validation run
+        val_x, val_y = tf.convert_to_tensor(val_x, dtype=tf.float32), tf.convert_to_tensor(val_y, dtype=tf.float32)
         write_log('Training model')
         history = net.fit(
-            train_generator,
+            self.__to_dataset(train_generator),
             validation_data=(val_x, val_y),
             epochs=self.num_epochs,
             callbacks=self.callbacks,
@@ -178,16 +206,18 @@ class RNN:
         write_log('Model trained')
         return net, history
 
-    def test(self, X: np.ndarray, Y: np.ndarray, feature_type: str, plot_result=False):
+    def test(self, X: np.ndarray, Y: np.ndarray, feature_type: str, plot_result=False, features_file: str = None, source: str = None):
         """
         Test the network:
         - Compute the MAE for each count in Y
         - Compute MAE where y in [1, 10]
         - Compute MAE where y in [1, 20]
         - Compute the MAE over all labels
-        :param X: The test data set (list of files)
+        :param X: The test data set (list of files, or array of merged records)
         :param Y: The labels
         :param feature_type: Feature type to use
+        :param features_file: If set, cache the features of X in this file, or load them from it if it is up to date
+        :param source: The file or dir X is loaded from. Features cached before it was last modified are outdated
         :return MAE
         """
         if self.__net is None:
@@ -195,22 +225,21 @@ class RNN:
         write_log('Testing network')
 
         generator = TestSetGenerator(X, Y, self.batch_size, feature_type)
+        if features_file is not None:
+            generator.cache_features(features_file, source)
         Y_hat = self.__net.predict(generator)
 
-        # Convert predictions to int: take median of poisson distribution
-        predictions = np.array([int(poisson(y_hat[0]).median()) for y_hat in Y_hat])
-        errors = {}
-        for speaker_count in range(min(Y), max(Y) + 1):
-            indices_with_count = np.argwhere(Y == speaker_count)
-            y_current = Y[indices_with_count]
-            predictions_current = predictions[indices_with_count]
-            error = mean_absolute_error(y_current, predictions_current)
-            errors[speaker_count] = error
+        # Convert predictions to int: take median of poisson distribution. Compute all medians in one vectorized call
+        predictions = poisson.median(Y_hat[:, 0]).astype(int)
+        absolute_errors = np.abs(Y - predictions)
+        # MAE for each count in one pass: sum the absolute errors per count, divide by the number of occurrences
+        counts = np.bincount(Y)
+        errors_per_count = np.bincount(Y, weights=absolute_errors) / np.maximum(counts, 1)
+        errors = {int(speaker_count): errors_per_count[speaker_count] for speaker_count in range(min(Y), max(Y) + 1) if counts[speaker_count]}
 
         for max_count in [10, 20]:
-            indices = np.argwhere(np.logical_and(Y >= 1, Y <= max_count))
-            errors[f'1_to_{max_count}'] = mean_absolute_error(Y[indices], predictions[indices])
-        errors['mean'] = mean_absolute_error(Y, predictions)
+            errors[f'1_to_{max_count}'] = np.mean(absolute_errors[(Y >= 1) & (Y <= max_count)])
+        errors['mean'] = np.mean(absolute_errors)
         if plot_result:
             self.__plot_test_results(errors)
         return errors
@@ -218,8 +247,12 @@ class RNN:
     def __plot_test_results(self, errors):
         """
         Create plot of results of self.test()
+        - Import matplotlib only here, such that it is not imported on each training run
+        - If no display is available, save the plot instead of showing it
         :param errors: The errors computed in test()
         """
+        import matplotlib.pyplot as plt
+
         x, y = [], []
         for i in range(1, 21):
             if i in errors:
@@ -231,4 +264,9 @@ class RNN:
         plt.ylabel('MAE')
         plt.xlabel('Max number of speakers')
         plt.ylim(0, 10)
-        plt.show()
+        # Without a display, matplotlib falls back to the non-interactive agg backend
+        if plt.get_backend().lower() == 'agg':
+            plt.savefig(f'results_{datetime.now():%Y%m%d_%H%M%S}.png', dpi=100)
+            plt.close()
+        else:
+            plt.show()
@@ -1,21 +1,24 @@
 import math
+import os
+from pathlib import Path
 
 import numpy as np
 import tensorflow_probability as tfp
 
 from TrainSetGenerator import TrainSetGenerator
-from scipy.io import wavfile
+from helpers import read_wavs_into, write_log, dequantize_mulaw
 
 tfd = tfp.distributions
 
 
 class TestSetGenerator(TrainSetGenerator):
     """
-    The TestSetGenerator consumes pre-merged files. Provided X is a list of merged files, Y a corresponding list of labels.
+    The TestSetGenerator consumes pre-merged files. Provided X is a list of merged files, or an array of merged records
+    (as generated by the DataLoader), Y a corresponding list of labels.
     Extends TrainSetGenerator, since it used many of its functionality
     The main difference is the generation of data points: We have pre-merged files, and thus do not need to merge them ourselves
     """
-    # list of filenames
+    # list of filenames, or array of merged records
     x: np.ndarray
     # list of speaker counts
     y: np.ndarray
@@ -23,16 +26,20 @@ class TestSetGenerator(TrainSetGenerator):
     # Use values in index to get indices
     indices: np.ndarray
 
+    # If set, batches are sliced from these precomputed features instead of preprocessed. See cache_features()
+    features: np.ndarray = None
+
     def __init__(self, x: np.ndarray, y: np.ndarray, batch_size: int, feature_type: str):
         """
         Initialize Generator
-        :param x: List of filenames
+        :param x: List of filenames, or array of merged records of shape (n, frames)
         :param y: Corresponding list of speaker counts
         :param batch_size:  Batch size
         :param feature_type:  Type of features to use. See set_feature_type
         """
         self.indices = np.arange(len(x))
-        self.x = np.array(x)
+        # Do not copy, x might be a memory-mapped array of records
+        self.x = np.asarray(x)
         self.y = np.array(y)
 
         self.batch_size = batch_size
@@ -60,22 +67,64 @@ class TestSetGenerator(TrainSetGenerator):
         :return: x,y: ndarrays
         """
         indices = self.indices[batch_index * self.batch_size: (batch_index + 1) * self.batch_size]
-        wavs = self.x[indices]
         labels = self.y[indices]
 
-        # read your data here using the batch lists, batch_x and batch_y
-        x = self._preprocess(wavs)
+        if self.features is not None:
+            x = self.features[indices]
+        else:
+            x = self._preprocess(self.x[indices])
         y = labels
 
         return np.array(x), np.array(y)
 
+    def cache_features(self, filename: str, source: str = None):
+        """
+        Compute the features of the full set once, and save them to filename. Afterwards, batches are sliced from
+        the saved features, such that they are not preprocessed again each time the set is used.
+        - If filename exists and is up to date, only load the features from it. It is outdated if its shape does not
+            match this set, or if source was modified after the features were saved
+        - The file is memory-mapped, such that features are only read from disk when a batch needs them
+        :param filename: The .npy file to save the features to. Should be unique for this set and feature type
+        :param source: The file or dir this set is loaded from, if any
+        """
+        shape = (len(self.indices),) + self.feature_shape
+        if os.path.exists(filename):
+            features = np.load(filename, mmap_mode='r')
+            outdated = features.shape != shape or (source is not None and os.path.getmtime(source) > os.path.getmtime(filename))
+            if not outdated:
+                self.features = features
+                return
+            del features
+            write_log(f'Features in {filename} are outdated')
+
+        write_log(f'Caching features in {filename}')
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, such that an interrupted run does not leave an incomplete cache behind
+        tmp_filename = f'{filename}.tmp'
+        features = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=np.float32, shape=shape)
+        for batch_index in range(len(self)):
+            indices = self.indices[batch_index * self.batch_size: (batch_index + 1) * self.batch_size]
+            features[indices] = self._preprocess(self.x[indices])
+        features.flush()
+        del features
+        os.replace(tmp_filename, filename)
+        self.features = np.load(filename, mmap_mode='r')
+
     def _preprocess(self, X):
         """
         Preprocess X
-        :param X: List of filenames
+        :param X: List of filenames, or array of merged records
         :return: prepocessed X
         """
-        # Read wav files
-        X = np.array([record for (_, record) in [wavfile.read(wav) for wav in X]], dtype='object')
+        if X.dtype.kind in 'US':
+            # Read wav files, and merge their speakers, directly into the padded array. Frames after 5 seconds are
+            # cut off in preprocessing anyway, hence do not read them
+            wavs = np.zeros((len(X), self.pad_to))
+            read_wavs_into(X, wavs)
+        elif X.dtype == np.uint8:
+            # Records quantized by the DataLoader
+            wavs = dequantize_mulaw(X).astype(float)
+        else:
+            wavs = X.astype(float)
         # Now use parent preprocess, which assumes loaded files
-        return super()._preprocess(X)
+        return super()._preprocess(wavs)
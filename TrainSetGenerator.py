@@ -4,10 +4,9 @@ import librosa
 import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
-from scipy.io import wavfile
 from tensorflow.keras.utils import Sequence
 
-from helpers import write_log
+from helpers import write_log, read_wav
 
 tfd = tfp.distributions
 
@@ -252,8 +251,8 @@ class TrainSetGenerator(Sequence):
         :param files: The files to merge
         :return: List containing wav data
         """
-        # Load ata
-        data = [record for (_, record) in [wavfile.read(wav) for wav in files]]
+        # Load data. Read serially, a thread pool costs more than it saves for the few files of one datapoint
+        data = [read_wav(wav) for wav in files]
         # Pad to longest file
         pad_to = len(max(data, key=len))
         data = np.array([np.pad(x, (0, pad_to - len(x))) for x in data])
@@ -344,21 +343,25 @@ class TrainSetGenerator(Sequence):
         :return: prepocessed X
         """
         # Merge all dimensions. For speaker_count > 1, each speaker initially has its own dimension (for test files)
-        X = np.array([np.sum(x, axis=1) if x.ndim > 1 else x for x in X], dtype='object')
+        X = [np.sum(x, axis=1) if x.ndim > 1 else x for x in X]
 
         # Randomize loudness to 50-70 db for each file
-        X = np.array([self.__randomize_loudness(x) for x in X], dtype='object')
+        X = [self.__randomize_loudness(x) for x in X]
 
         # Apply augmentation
         if self.augment:
-            X = np.array([self.__augment(x) for x in X], dtype='object')
-
-        # Normalize to -1, 1
-        X = [x / np.max(np.abs(x)) for x in X]
-        # Pad to and cut off at 5 seconds
-        X = np.array([np.pad(x, (0, max(self.pad_to - len(x), 0)))[:self.pad_to] for x in X])
+            X = [self.__augment(x) for x in X]
+
+        # Pad to and cut off at 5 seconds. Copy into one preallocated array, instead of padding each file separately
+        padded = np.zeros((len(X), self.pad_to))
+        for i, x in enumerate(X):
+            n = min(len(x), self.pad_to)
+            padded[i, :n] = x[:n]
+        X = padded
+        # Normalize to -1, 1. Normalize after cutting off, like the test records, which are only read up to pad_to
+        X /= np.max(np.abs(X), axis=1, keepdims=True)
         # nans and infs to 0 and float.max, to prevent librosa crash
-        X = np.nan_to_num(X.astype(float))
+        X = np.nan_to_num(X, copy=False)
         # Load Short Time Fourier Transformas
         stft = np.abs([librosa.stft(np.array(x, dtype=float), n_fft=self.frame_length, hop_length=self.n_overlap) for x in X])
         stft = librosa.util.normalize(stft)
@@ -1,3 +1,15 @@
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.io import wavfile
+
+# Format tags of the wav files that read_wav parses itself
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
 def write_log(msg, error=False, kill=False):
     """
     Write a log to stdout
@@ -9,3 +21,96 @@ def write_log(msg, error=False, kill=False):
     print(f'[{prefix}] - {msg}')
     if kill:
         exit()
+
+
+def read_wav(file, max_frames=None):
+    """
+    Read a wav file
+    - For 16 bit PCM files, only parse the header, and read (at most max_frames frames of) the data chunk directly
+    - For other formats, fall back to scipy
+    :param file: The filename
+    :param max_frames: If set, cut off the data after this number of frames, without reading the remaining frames
+    :return: The wav data. Like scipy, shape is (frames,) for mono files and (frames, channels) otherwise
+    """
+    with open(file, 'rb') as fid:
+        riff, _, wave = struct.unpack('<4sI4s', fid.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{file} is not a wav file')
+        # Walk over the chunks until we find the data chunk. Chunks are padded to an even size
+        format_tag, channels, bits_per_sample = None, None, None
+        while True:
+            header = fid.read(8)
+            if len(header) < 8:
+                raise ValueError(f'{file} does not contain a data chunk')
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'data':
+                break
+            chunk = fid.read(size + size % 2)
+            if chunk_id == b'fmt ':
+                format_tag, channels, _, _, _, bits_per_sample = struct.unpack('<HHIIHH', chunk[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE:
+                    # The actual format tag is the start of the sub format GUID
+                    format_tag, = struct.unpack('<H', chunk[24:26])
+        if format_tag != WAVE_FORMAT_PCM or bits_per_sample != 16:
+            _, record = wavfile.read(file)
+            return record[:max_frames]
+
+        frames = size // (channels * 2)
+        if max_frames is not None:
+            frames = min(frames, max_frames)
+        record = np.fromfile(fid, dtype='<i2', count=frames * channels).reshape(-1, channels)
+    return record[:, 0] if channels == 1 else record
+
+
+def read_wavs(files, max_frames=None):
+    """
+    Read a list of wav files. Reading is I/O bound, hence read the files concurrently using a thread pool
+    :param files: The filenames
+    :param max_frames: If set, cut off each file after this number of frames. See read_wav
+    :return: List containing the wav data of each file, in the same order as files
+    """
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(lambda wav: read_wav(wav, max_frames), files))
+
+
+def read_wavs_into(files, out):
+    """
+    Read a list of wav files, and write each file into its row of out, summed over its channels.
+    Files are cut off at the row length, and read concurrently using a thread pool
+    :param files: The filenames
+    :param out: Preallocated array of shape (len(files), frames). Frames after the end of a file are left untouched
+    """
+
+    def read_into(i):
+        record = read_wav(files[i], out.shape[1])
+        n = len(record)
+        if record.ndim == 1:
+            out[i, :n] = record
+        else:
+            np.sum(record, axis=1, out=out[i, :n])
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(read_into, range(len(files))))
+
+
+def quantize_mulaw(x, mu=255):
+    """
+    Quantize a signal to 8 bits, using mu-law companding. Keeps more precision for quiet samples than linear quantization
+    - The companded signal is mapped mid-tread onto 1..255, such that 0 (e.g. padding) is stored exactly as 128
+    :param x: The signal, in [-1, 1]
+    :param mu: The compression parameter. 255 for 8 bits
+    :return: The quantized signal, as uint8
+    """
+    y = np.sign(x) * np.log1p(mu * np.abs(x)) / np.log1p(mu)
+    return (np.round(y * 127) + 128).astype(np.uint8)
+
+
+def dequantize_mulaw(x, mu=255):
+    """
+    Inverse of quantize_mulaw
+    :param x: The quantized signal, as uint8
+    :param mu: The compression parameter used to quantize
+    :return: The signal, in [-1, 1], as float32
+    """
+    y = (x.astype(np.float32) - 128) / 127
+    return (np.sign(y) * np.expm1(np.abs(y) * np.log1p(mu)) / mu).astype(np.float32)
@@ -18,6 +18,8 @@ libri_dir = './data/LibriCount/test'
 TRAIN_AND_TEST_NETWORK = True
 RUN_EXPERIMENTER = True
 FEATURE_TYPE = TrainSetGenerator.FEATURE_TYPE_STFT
+# If true, store the generated test set as 8 bit mu-law instead of float16. Halves its size, at the cost of precision
+QUANTIZE_TEST_SET = False
 
 
 def train_and_test_network():
@@ -31,6 +33,7 @@ def train_and_test_network():
     # Load data from filesystem
     data_loader = DataLoader(train_dir, test_src_dr, test_dest_dir)
     data_loader.force_recreate = False
+    data_loader.quantize = QUANTIZE_TEST_SET
     data_loader.min_speakers = min_speakers
     data_loader.max_speakers = max_speakers
 